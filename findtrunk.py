@@ -133,6 +133,32 @@ def arg_parser():
     return parser.parse_args()
 
 
+def compute_trunk(parent, is_leaf):
+    """
+    This function counts how many times each edge of the tree topology is traversed walking
+    backward from every leaf to the root. Each walk crosses the edge of every internal ancestor
+    other than the root, hence the count of an edge equals the number of leaves descending from
+    its child node.
+
+    `parent` is a list containing the UID of the parent of each node (-1 for the root) and
+    `is_leaf` is a list flagging the leaf nodes. The UIDs must follow a level-order (i.e. each
+    parent has a lower UID than its children).
+
+    Returns:
+        It returns a list containing the count of the edge subtending each node UID
+    """
+    node_count = len(parent)
+
+    # scanning the UIDs backward visits all the children before their parent
+    leaf_count = [int(leaf) for leaf in is_leaf]
+    for uid in range(node_count - 1, 0, -1):
+        leaf_count[parent[uid]] += leaf_count[uid]
+
+    # leaves and root do not have any count on their edge
+    return [count if not leaf and up != -1 else 0
+            for count, leaf, up in zip(leaf_count, is_leaf, parent)]
+
+
 def main(args):
     """
     This function executes the routines required by the program to identify the tree trunk and it
@@ -142,15 +168,17 @@ def main(args):
     """
 
     # Prepare output variables
+    input_dir = os.path.dirname(args.input_file)
+    input_name = os.path.basename(args.input_file)
     if not args.output_file:
-        args.output_file = os.path.dirname(args.input_file) + '/' + args.data_label + '_out.tree'
+        args.output_file = input_dir + '/' + args.data_label + '_out.tree'
 
     # Prepare logging device
     numeric_level = getattr(logging, args.log_level.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % args.log_level)
 
-    logging.getLogger(__product__)
+    logger = logging.getLogger(__product__)
     if args.log_to_file:
 
         logging.basicConfig(filename=args.log_file,
@@ -159,74 +187,74 @@ def main(args):
                             datefmt='%m/%d/%Y %I:%M:%S %p')
     else:
 
-        args.log_file = os.path.dirname(args.input_file) + '/' + args.data_label + '_out.log'
+        args.log_file = input_dir + '/' + args.data_label + '_out.log'
 
         logging.basicConfig(level=numeric_level,
                             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p')
 
-    logging.debug(__project__+":"+__product__+" - Execution started")
+    logger.debug("%s:%s - Execution started", __project__, __product__)
 
     # Read the tree file
     tree = dendropy.Tree.get(path=args.input_file,
                              schema=args.input_format,
                              extract_comment_metadata=True)
 
-    # Initialise feature-storing-objects
-    edgedict = dict()
-    edgelist = list()
-
     # ------------------------------------------------------------------------------------------
     # Add UIDs to each node/edge in the tree
-    logging.debug(__project__ + ":" + __product__ + " - Adding UIDs to nodes")
-    i = 0
-    for node in tree.levelorder_node_iter():
+    logger.debug("%s:%s - Adding UIDs to nodes", __project__, __product__)
+    # Progress is reported every 1000 items only, flushing stdout on each of them dominates the
+    # labelling time on large trees.
+    # The topology is stored at the same time in flat arrays indexed by node UID, the level-order
+    # guarantees that each parent is labelled before its children (the root has no parent: -1)
+    parent = list()
+    is_leaf = list()
+    for i, node in enumerate(tree.levelorder_node_iter()):
         node.label = i
-        sys.stdout.write("\r%s | Labelling node: %3d" % (os.path.basename(args.input_file), i))
-        sys.stdout.flush()
-        i += 1
-    sys.stdout.write("\n")
-
-    logging.debug(__project__ + ":" + __product__ + " - Adding UIDs to edges")
-    i = 0
-    for edge in tree.levelorder_edge_iter():
+        parent.append(node.parent_node.label if node.parent_node is not None else -1)
+        is_leaf.append(node.is_leaf())
+        if i % 1000 == 0:
+            sys.stdout.write("\r%s | Labelling node: %3d" % (input_name, i))
+            sys.stdout.flush()
+    sys.stdout.write("\r%s | Labelling node: %3d\n" % (input_name, i))
+
+    logger.debug("%s:%s - Adding UIDs to edges", __project__, __product__)
+    # the edges are kept in labelling order, so that the annotation does not traverse them again
+    edges = list()
+    for i, edge in enumerate(tree.levelorder_edge_iter()):
         edge.label = i
-        edgedict[i] = 0
-        sys.stdout.write("\r%s | Labelling edge: %3d" % (os.path.basename(args.input_file), i))
-        sys.stdout.flush()
-        i += 1
-    sys.stdout.write("\n")
+        edges.append(edge)
+        if i % 1000 == 0:
+            sys.stdout.write("\r%s | Labelling edge: %3d" % (input_name, i))
+            sys.stdout.flush()
+    sys.stdout.write("\r%s | Labelling edge: %3d\n" % (input_name, i))
+    edge_count = i + 1
 
     # ------------------------------------------------------------------------------------------
     # Infer the trunk from tree topology using a reverse traversal (from leaf-to-root)
-    logging.debug(__project__ + ":" + __product__ + " - Computing relative root distances")
-    tree.max_distance_from_root()
-    for leaf in tree.leaf_node_iter():
-
-        backwardnode = leaf.parent_node
-
-        while backwardnode.root_distance > 0:
-            edgelist.append((backwardnode.edge.label, 1))
-
-            backwardnode = backwardnode.parent_node
-
-    for pair in edgelist:
-        edgedict[pair[0]] += pair[1]
+    logger.debug("%s:%s - Computing edge traversal counts", __project__, __product__)
+    # Node and edge UIDs are assigned in the same level-order, the edge UID matches the child one
+    trunk = compute_trunk(parent, is_leaf)
 
     # ------------------------------------------------------------------------------------------
-    # Add feature on topology
-    for edge in tree.levelorder_edge_iter():
-        edge.annotations.add_new(name="trunk", value=edgedict[edge.label])
-
-    # Count all the edges in the tree topology (TEST)
-    inst_edges = CEdges()
-    inst_edges.count_edges(tree)
-    logging.debug(__project__ + ":" + __product__ + " - Total number of edges is " + str(inst_edges.edge_number))
+    # Add feature on topology. The annotations are built once per distinct count and then shared
+    # by all the edges with the same count, avoiding the construction of one object per edge
+    trunk_annotations = dict()
+    for edge in edges:
+        count = trunk[edge.label]
+        if count in trunk_annotations:
+            edge.annotations.add(trunk_annotations[count])
+        else:
+            trunk_annotations[count] = edge.annotations.add_new(name="trunk", value=count)
+
+    # The total number of edges in the tree topology is already known from the labelling
+    logger.debug("%s:%s - Total number of edges is %d", __project__, __product__, edge_count)
 
     # ------------------------------------------------------------------------------------------
     # Save new tree topology
     tree.write(path=args.output_file, schema='nexus')
-    logging.debug(__project__+":"+__product__+" - Featured tree saved in: " + args.output_file)
+    logger.debug("%s:%s - Featured tree saved in: %s", __project__, __product__,
+                 args.output_file)
 
 
 # Main execution routine
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import csv
+import argparse
+import tempfile
 import findtrunk
+import trunktraitevolution
 import unittest
 import dendropy
 
@@ -25,6 +30,71 @@ class TestEdges(unittest.TestCase):
         self.assertIsInstance(tmp_cedge_inst.edge_number,int)
 
 
+class TestTrunk(unittest.TestCase):
+
+    def test_ComputeTrunk_CountsDescendingLeaves(self):
+        # ((a,b),c): root 0, internal 1, c 2, a 3, b 4
+        trunk = findtrunk.compute_trunk([-1, 0, 0, 1, 1], [False, False, True, True, True])
+        self.assertEqual(trunk, [0, 2, 0, 0, 0])
+
+    def test_ComputeTrunk_NewickTree(self):
+        nodes = list(Data.TREE_NEWICK.levelorder_node_iter())
+        uids = dict((node, uid) for uid, node in enumerate(nodes))
+        parent = [uids[node.parent_node] if node.parent_node is not None else -1 for node in nodes]
+        is_leaf = [node.is_leaf() for node in nodes]
+        trunk = findtrunk.compute_trunk(parent, is_leaf)
+        self.assertEqual(sorted(trunk, reverse=True)[:5], [5, 3, 2, 2, 2])
+        self.assertEqual(sum(trunk[uid] for uid in range(len(nodes)) if is_leaf[uid]), 0)
+
+
+class TestTrunkEdges(unittest.TestCase):
+
+    DATA = "((a:1,b:1):2[&trunk=2,height=1,location=B],c:3)[&trunk=0,height=3,location=A];"
+
+    def test_CommentMetadata_RequestedFields(self):
+        tree = dendropy.Tree.get(data="(a:1[&height=2,height_95%_HPD={1.5,2.5},location=\"B\"]);",
+                                 schema="newick", extract_comment_metadata=False)
+        node = tree.seed_node.child_nodes()[0]
+        values = trunktraitevolution.comment_metadata(node, ('height', 'location', 'trunk'))
+        self.assertEqual(values, {'height': '2', 'location': 'B'})
+
+    def test_TrunkEdges_LabelZero(self):
+        tree = dendropy.Tree.get(data=self.DATA, schema="newick", extract_comment_metadata=False)
+        tree.seed_node.label = 1
+        tree.seed_node.child_nodes()[0].label = 0
+        rows = list(trunktraitevolution.trunk_edges(tree, 'location', 0))
+        self.assertEqual(rows, [(1, 0, '3', '1', 2.0, 'A', 'B', 1)])
+
+    def test_TrunkEdges_MissingTrunk(self):
+        data = "((a:1[&location=A],b:1[&location=B])0.9:2[&location=A,height=1]," \
+               "c:3[&location=B])[&location=A,height=3];"
+        tree = dendropy.Tree.get(data=data, schema="newick", extract_comment_metadata=False)
+        with self.assertRaises(TypeError):
+            list(trunktraitevolution.trunk_edges(tree, 'location', 0))
+
+
+class TestSummary(unittest.TestCase):
+
+    # the trunk shows the A->B switch before the B->B permanence and then the A->A permanence
+    DATA = "((((e:1,f:1)4:1[&trunk=2,height=1,location=B],d:1)2:1[&trunk=3,height=2,location=B]," \
+           "((h:1,i:1)5:1[&trunk=2,height=1,location=A],g:1)3:1[&trunk=3,height=2,location=A])" \
+           "1:1[&trunk=4,height=3,location=B],c:1)0[&trunk=0,height=4,location=A];"
+
+    def test_Summary_VFromOrder(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_file = os.path.join(tmpdir, 'in.tree')
+            with open(input_file, 'w') as treefile:
+                treefile.write(self.DATA)
+            args = argparse.Namespace(input_file=input_file, input_format='newick',
+                                      output_file=os.path.join(tmpdir, 'out'),
+                                      feature_annotation='location', trunk_threshold=0,
+                                      data_label='', log_level='WARNING', log_to_file='')
+            trunktraitevolution.main(args)
+            with open(args.output_file + '_summary.csv', newline='') as csvfile:
+                rows = list(csv.reader(csvfile))
+        self.assertEqual(rows, [['VFROM', 'VTO', 'DURATION'], ['A', 'A', '1.0'], ['B', 'B', '1.0']])
+
+
 # Main execution routine
 if __name__ == "__main__":
     unittest.main()
@@ -69,6 +69,8 @@ import dendropy
 import os.path
 import logging
 import csv
+import collections
+import re
 
 # Authorship information
 
@@ -85,6 +87,9 @@ __maintainer__ = "Lorenzo Gatti"
 __email__ = "lorenzo.gatti@zhaw.ch"
 __status__ = "Development"
 
+# Fields of the BEAST-style metadata comments (i.e. [&name=value,name={value,value}])
+COMMENT_FIELD_PATTERN = re.compile(r'([^=,]+)=(\{[^}]*\}|[^,]*)(?:,|$)')
+
 
 # Routines
 def arg_parser():
@@ -119,6 +124,101 @@ def arg_parser():
     return parser.parse_args()
 
 
+def comment_metadata(node, names):
+    """
+    This function retrieves the requested fields from the BEAST-style metadata comments attached
+    to a node read without extracting the comment metadata, avoiding the construction of an
+    annotation per field
+
+    `node` is a tree node and `names` the collection of the field names to retrieve.
+
+    Returns:
+        It returns a dictionary containing the value of each requested field found in the comments
+    """
+    values = dict()
+    for comment in node.comments:
+        if comment.startswith('&'):
+            for name, value in COMMENT_FIELD_PATTERN.findall(comment[1:]):
+                name = name.strip()
+                if name in names:
+                    values[name] = value.strip().strip('"')
+
+    return values
+
+
+def trunk_edges(tree, feature_annotation, trunk_threshold):
+    """
+    This function traverses the tree topology in preorder and it retrieves the edges placed on the
+    tree trunk, calling the switches of the discrete trait occurring on them
+
+    `tree` is a tree topology annotated by `findtrunk` and read without extracting the comment
+    metadata, `feature_annotation` the name of the discrete trait and `trunk_threshold` the lower
+    bound on the trunk value of the edges.
+
+    Returns:
+        It yields a tuple per trunk edge, containing the ids, the ages of the parent and child
+        nodes, the edge length, the trait values and 1 when the trait switches (0 otherwise)
+    """
+    logger = logging.getLogger(__product__)
+
+    # Parse the annotations used by the analysis once per node
+    names = ('trunk', 'height', feature_annotation)
+    trunk = dict()
+    height = dict()
+    feature = dict()
+    for node in tree.preorder_node_iter():
+        node_values = comment_metadata(node, names)
+        trunk[node] = node_values.get('trunk')
+        height[node] = node_values.get('height')
+        feature[node] = node_values.get(feature_annotation)
+
+    # nodes already reached as trunk children, kept outside of the tree annotations
+    visited = set()
+    # per each node in the tree topology, loop over the child nodes and retrieve the length
+    # of the branch grouped according to
+    for node in tree.preorder_node_iter():
+        # check if the node has been already visited before
+        logger.debug("%s:%s - Visiting node %s", __project__, __product__, node.label)
+        if id(node) not in visited:
+            # get the requested annotation for the parent node
+            parent_annotation = feature[node]
+            parent_id = node.label
+            parent_height = height[node]
+            # Per each child node in the tree starting from the node selected in
+            # preorder-traversing
+            for child in node.child_node_iter():
+
+                # Check if the child has been labelled (0 is a valid label)
+                if child.label is not None:
+                    # retrieve the edges occurring on the trunk of the tree (a labelled child
+                    # without trunk value means the tree has not been annotated by findtrunk)
+                    if int(trunk[child]) > trunk_threshold:
+                        # Get annotation of the current child node
+                        child_annotation = feature[child]
+
+                        # Call switches
+                        if parent_annotation != child_annotation:
+                            c = 1
+                        else:
+                            c = 0
+
+                        yield (parent_id,
+                               child.label,
+                               parent_height,
+                               height[child],
+                               child.edge.length,
+                               parent_annotation,
+                               child_annotation,
+                               c)
+
+                        # Re-assigning internal values
+                        parent_annotation = child_annotation
+                        parent_id = child.label
+                        parent_height = height[child]
+                        # Complete visiting the node, flagging the successful visit
+                        visited.add(id(child))
+
+
 def main(args):
     """
     This function executes the routines required by the program to identify the number of switches
@@ -128,10 +228,10 @@ def main(args):
     """
 
     # Prepare output variables
+    input_dir = os.path.dirname(args.input_file)
     if not args.output_file:
 
-        filename = os.path.dirname(args.input_file) + '/' + args.data_label + '_' \
-                   + args.feature_annotation
+        filename = input_dir + '/' + args.data_label + '_' + args.feature_annotation
 
         args.output_file = filename
 
@@ -140,7 +240,7 @@ def main(args):
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % args.log_level)
 
-    logging.getLogger(__product__)
+    logger = logging.getLogger(__product__)
     if args.log_to_file:
 
         logging.basicConfig(filename=args.log_file,
@@ -149,113 +249,57 @@ def main(args):
                             datefmt='%m/%d/%Y %I:%M:%S %p')
     else:
 
-        args.log_file = os.path.dirname(args.input_file) + '/' + args.data_label + '_out.log'
+        args.log_file = input_dir + '/' + args.data_label + '_out.log'
 
         logging.basicConfig(level=numeric_level,
                             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p')
 
-    logging.debug(__project__ + ":" + __product__ + " - Execution started")
+    logger.debug("%s:%s - Execution started", __project__, __product__)
 
-    # Read the tree file
+    # Read the tree file, only the few metadata fields used are parsed from the node comments
     tree = dendropy.Tree.get(path=args.input_file,
                              schema=args.input_format,
-                             extract_comment_metadata=True)
+                             extract_comment_metadata=False)
 
-    feature_permanence = dict()
+    # permanence of the discrete trait keyed by the (parent, child) pair of trait values, the
+    # parent values are also recorded in order of appearance to sort the summary rows
+    feature_permanence = collections.defaultdict(float)
+    feature_order = collections.OrderedDict()
 
-    with open(args.output_file+'_switches.csv', 'w') as csvfile:
+    with open(args.output_file+'_switches.csv', 'w', newline='', buffering=1 << 20) as csvfile:
 
         fieldnames = ['FROM-ID', 'TO-ID', 'F-AGE', 'T-AGE', 'DURATION', 'VFROM', 'VTO', 'C']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        # rows are stored as tuples following the fieldnames order and written in chunks
+        rows = list()
         sc = 0
-        # per each node in the tree topology, loop over the child nodes and retrieve the length
-        # of the branch grouped according to
-        for node in tree.preorder_node_iter():
-        #for node in tree.leaf_node_iter():
-            # check if the node has been already visited before
-            logging.debug(__project__ + ":" + __product__ + " - Visiting node " + str(node.label))
-            #if 'visited' not in node.annotations.values_as_dict().keys():
-            if not node._annotations.get_value('visited'):
-                # get the requested annotation for the parent node
-                #parent_annotation = node.annotations.values_as_dict()[args.feature_annotation]
-                parent_annotation = node._annotations.get_value(args.feature_annotation)
-                parent_id = node.label
-                #parent_height = node.annotations.values_as_dict()['height']
-                parent_height = node._annotations.get_value('height')
-                # Per each child node in the tree starting from the node selected in
-                # preorder-traversing
-                for child in node.child_nodes():
-
-                    # Check if the child has been labelled with a number
-                    if child.label:
-                        # count the number of switches for the discrete trait occurring on the
-                        # trunk of the tree
-                        #if int(child.annotations.values_as_dict()['trunk']) > args.trunk_threshold:
-                        if int(child._annotations.get_value('trunk')) > args.trunk_threshold:
-                            # Get annotation of the current child node
-                            child_annotation = child._annotations.get_value(args.feature_annotation)
-                         #   child_annotation = child.annotations.values_as_dict()[
-                         #       args.feature_annotation]
-
-                            # Compute the permanence
-                            if parent_annotation not in feature_permanence:
-                                feature_permanence[parent_annotation] = {}
-
-                            if child_annotation not in feature_permanence[parent_annotation]:
-                                feature_permanence[parent_annotation][child_annotation] = \
-                                    child.edge.length
-                            else:
-                                feature_permanence[parent_annotation][child_annotation] += \
-                                    child.edge.length
-
-                            #    feature_permanence[child_annotation] += node.edge.length
-                            # else:
-                            #    feature_permanence[child_annotation] = node.edge.length
-
-                            # Call switches
-                            if parent_annotation != child_annotation:
-                                c = 1
-                                sc += 1
-                            else:
-                                c = 0
-
-                            # Store
-                            writer.writerow({'FROM-ID': parent_id,
-                                             'TO-ID': child.label,
-                                             'F-AGE': parent_height,
-                                             #'T-AGE': child.annotations.values_as_dict()['height'],
-                                             'T-AGE': child._annotations.get_value('height'),
-                                             'DURATION': child.edge.length,
-                                             'VFROM': parent_annotation,
-                                             'VTO': child_annotation,
-                                             'C': c})
-
-                            # Re-assigning internal values
-                            parent_annotation = child_annotation
-                            parent_id = child.label
-                            #parent_height = child.annotations.values_as_dict()['height']
-                            parent_height = child._annotations.get_value('height')
-                            # Complete visiting the node, adding an annotation indicating the
-                            # successful visit
-                            child.annotations.add_new(name="visited", value=1)
-
-    logging.info(__project__ + ":" + __product__ + " - The discrete trait [" +
-                 args.feature_annotation + '] shows ' + str(sc) + ' switches on the trunk')
-
-    with open(args.output_file+'_summary.csv', 'w') as csvfile:
+        for row in trunk_edges(tree, args.feature_annotation, args.trunk_threshold):
+            parent_id, child_id, parent_height, child_height, duration, vfrom, vto, c = row
+            # Compute the permanence and count the switches
+            feature_permanence[vfrom, vto] += duration
+            feature_order.setdefault(vfrom)
+            sc += c
+            rows.append(row)
+            if len(rows) >= 1024:
+                writer.writerows(rows)
+                del rows[:]
+
+        writer.writerows(rows)
+
+    logger.info("%s:%s - The discrete trait [%s] shows %d switches on the trunk",
+                __project__, __product__, args.feature_annotation, sc)
+
+    with open(args.output_file+'_summary.csv', 'w', newline='') as csvfile:
 
         fieldnames = ['VFROM', 'VTO', 'DURATION']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for vfrom in feature_permanence:
-            for vto in feature_permanence[vfrom]:
-                if vfrom == vto:
-                    writer.writerow({'VFROM': vfrom,
-                                     'VTO': vto,
-                                     'DURATION': feature_permanence[vfrom][vto]})
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+
+        for vfrom in feature_order:
+            if (vfrom, vfrom) in feature_permanence:
+                writer.writerow((vfrom, vfrom, feature_permanence[vfrom, vfrom]))
 
     # pprint.pprint(feature_permanence, width=1)
 